@@ -13,6 +13,7 @@ import os
 import sys
 import re
 import math
+from collections import namedtuple
 from datetime import datetime
 
 # Constants
@@ -27,6 +28,7 @@ IndexIncForSpeedCanopy = 12
 A_GRAVITY   = 9.80665     # Standard acceleration due to gravity (m/s^2)
 SL_PRESSURE = 101325      # Sea level pessure (Pa)
 SL_PRESSURE_DPA = 10132.5
+INV_SL_PRESSURE_DPA = 1.0 / SL_PRESSURE_DPA
 BARO_POWER  = 0.190263
 STANDARD_TEMP_k = 44330.8
 
@@ -35,11 +37,18 @@ LAPSE_RATE  = 0.0065      # Temperature lapse rate (K/m)
 SL_TEMP     = 288.15      # Sea level temperature (K)
 MM_AIR      = 0.0289644   # Molar mass of dry air (kg/mol)
 GAS_CONST   = 8.31447     # Universal gas constant (J/mol/K)
+R_AIR       = GAS_CONST / MM_AIR                          # Specific gas constant of dry air (J/kg/K)
+AIR_PRESSURE_POWER = A_GRAVITY * MM_AIR / GAS_CONST / LAPSE_RATE
+
+# Reciprocals of the speed windows, and the factor turning a per-sample m/s change into g
+InvTimeIncForSpeedInFF   = 1.0 / TimeIncForSpeedInFF
+InvTimeIncForSpeedCanopy = 1.0 / TimeIncForSpeedCanopy
+InvAccelScale            = 1.0 / (TimeStep * A_GRAVITY)
 
 # From Mike Cooper's post at
 #  https://groups.google.com/g/flysight-devs/c/-J4KIcQ5ELs?pli=1
 def AirPressure(alti):
-    airPressure = SL_PRESSURE * pow(1 - LAPSE_RATE * alti / SL_TEMP, A_GRAVITY * MM_AIR / GAS_CONST / LAPSE_RATE)
+    airPressure = SL_PRESSURE * (1 - LAPSE_RATE * alti / SL_TEMP) ** AIR_PRESSURE_POWER
     return airPressure
     
 def TempAtAltitude(alti):
@@ -47,7 +56,7 @@ def TempAtAltitude(alti):
     return temperature
     
 def AirDensity(alti):
-    airDensity = AirPressure(alti) / (GAS_CONST / MM_AIR) / TempAtAltitude(alti)
+    airDensity = AirPressure(alti) / R_AIR / TempAtAltitude(alti)
     return airDensity
     
 #     
@@ -62,19 +71,19 @@ def TasToEas(alti, speed):
 # From flysite 
 # https://github.com/flysight/flysight-viewer-qt/blob/9427b7d33abf6343a38f637f83da8797d6635472/src/ubx.cpp#L23
 mSasTable = [1024, 1077, 1135, 1197, 1265, 1338, 1418, 1505, 1600, 1704, 1818, 1944]
+SAS_TABLE_STEP = 1024 * 1024                          # hMSL spacing between table entries
+SAS_TABLE_MAX  = SAS_TABLE_STEP * (len(mSasTable) - 1) # 11534336
+mSasTableSlope = [(y2 - y1) / SAS_TABLE_STEP for y1, y2 in zip(mSasTable, mSasTable[1:])]
    
 def SpeedMultiplier(hMSL):    
     if (hMSL < 0):
         speed_mul = mSasTable[0]
-    elif hMSL >= 11534336:
-        speed_mul = mSasTable[11]
+    elif hMSL >= SAS_TABLE_MAX:
+        speed_mul = mSasTable[-1]
     else:
-        h = hMSL / 1024
-        i = int(h / 1024)
-        j = h % 1024
-        y1 = mSasTable[i]
-        y2 = mSasTable[i + 1]
-        speed_mul = y1 + ((y2 - y1) * j) / 1024
+        i, j = divmod(hMSL, SAS_TABLE_STEP)
+        i = int(i)
+        speed_mul = mSasTable[i] + mSasTableSlope[i] * j
     return speed_mul    
     
 def TasToSas(alti, speed):    
@@ -99,76 +108,104 @@ def MiliBarToDecaPa(p):
 def DecaPaToMiliBar(p):
     return p / 10.0    
 
+MSEC_TO_KMH = 3.6
+MSEC_TO_MPH = 2.23694
+M_TO_FT     = 3.28084
+
 def MsecTokmh(m):
-    return round(m * 3.6)
+    return round(m * MSEC_TO_KMH)
     
 def MsecTomph(m):
-    return round(m * 2.23694)
+    return round(m * MSEC_TO_MPH)
 
 def MToft(m):
-    return round(m * 3.28084)   
+    return round(m * M_TO_FT)   
     
 def MsecToftsec(m):
-    return round(m * 3.28084)
+    return round(m * M_TO_FT)
     
 def MsecToMsec(m):
     return round(m) 
        
+# Standard-atmosphere altitude above sea level (m) for a pressure in dPa
+def PressureToSeaLevelMeter(p):
+	return STANDARD_TEMP_k * (1.0 - (p * INV_SL_PRESSURE_DPA) ** BARO_POWER)
+
 def PressureToMeter(p, GroundLevelMeter):
-	return STANDARD_TEMP_k * (1.0 - pow(p / SL_PRESSURE_DPA, BARO_POWER)) - GroundLevelMeter
+	return PressureToSeaLevelMeter(p) - GroundLevelMeter
 
 # Based on LB's Calculation. Assume 15C at sea level
 def PressureToTemp15C(p, GroundLeveldPa):
     return (15 - (p + GroundLeveldPa)*0.0065)
 
-#
-# Main
-#     
-def main():
-    if len(sys.argv) < 2:
-        print("Missing arguments: %s <input.txt> <output>" % sys.argv[0])
-        sys.exit()
+# Vertical speed from index start onwards. Each sample is differenced over the freefall
+# window where InFreefall is set and over the canopy window elsewhere.
+def DifferenceSpeeds(MeterList, start, InFreefall):
+    return [(ffprev - cur) * InvTimeIncForSpeedInFF if freefall else (canprev - cur) * InvTimeIncForSpeedCanopy
+            for freefall, ffprev, canprev, cur in zip(InFreefall,
+                                                      MeterList[start-IndexIncForSpeedInFF:],
+                                                      MeterList[start-IndexIncForSpeedCanopy:],
+                                                      MeterList[start:])]
+
+# Per-sample columns of a jump, kept together so they are computed and written as one unit.
+# Speed/accel columns start IndexIncForSpeedInFF samples after exit.
+Profile = namedtuple('Profile', ['AltiMeterList', 'SpeedList', 'SasSpeedList', 'AccelList', 'SasMeterList', 'DeploymentIndex'])
+
+# Altitude, SAS altitude, speed and acceleration profiles from the raw pressure readings (dPa)
+def ComputeProfile(JumpDataInt, GroundLevelMeter, icao_div, hs, ht, DeploymentAltitude):
+    # Pressure altitude above sea level, shared by the altimeter and SAS tables
+    BaroMeterList = [PressureToSeaLevelMeter(readingDBar) for readingDBar in JumpDataInt]
+    AltiMeterList = [baro - GroundLevelMeter for baro in BaroMeterList]
+                
+    # SAS meter table
+    SasScale  = 1+(icao_div*0.004)
+    SasOffset = hs-ht
+    SasMeterList = [baro*SasScale+SasOffset+GroundLevelMeter for baro in BaroMeterList]
         
-    inf= sys.argv[1]   
-    if len(sys.argv) < 3: 
-        outf = None
-    else:
-        outf = sys.argv[2]
-    
-    if(not os.path.isfile(inf)):
-        print("Input file \"%s\" does not exist" % inf)
-        sys.exit(1)
+    #set deployment index
+    DeploymentIndex = next((i for i, alti in enumerate(AltiMeterList) if alti <= DeploymentAltitude), -1)
     
+    #speed calculations
+    # Select the differencing window from one altitude mask shared by both profiles
+    SpeedStart = IndexExit+IndexIncForSpeedInFF
+    InFreefall = [alti > DeploymentAltitude for alti in AltiMeterList[SpeedStart:]]
+
+    # setup the contants for SAS as per LB's code                
+    SpeedList = DifferenceSpeeds(AltiMeterList, SpeedStart, InFreefall)
+        
+    # Now calculate SAS
+    SasSpeedList = DifferenceSpeeds(SasMeterList, SpeedStart, InFreefall)
+
+    # Calculate acceleration (g) from speeds rounded to whole m/s
+    RoundedSpeeds = [MsecToMsec(speed) for speed in SpeedList]
+    AccelList = [(speed - prevspeed) * InvAccelScale
+                 for prevspeed, speed in zip(RoundedSpeeds, RoundedSpeeds[1:])]
+
+    return Profile(AltiMeterList, SpeedList, SasSpeedList, AccelList, SasMeterList, DeploymentIndex)
+
+# Extract one ProtrackII txt file to CSV. Without outf, writes <JumpNumber>.csv in outdir.
+# written, if given, collects the CSV paths of this run so a jump number seen twice is not overwritten.
+# Returns False if the file is not a valid ProtrackII profile or its CSV was already written.
+def ExtractFile(inf, outf, outdir="", written=None):
     # Reading in file
-    lined = []
     with open(inf) as f:
-        for line in f:
-            line = line.replace('\n','')
-            lined.append(line)
+        lined = f.read().splitlines()
         
     lines = len(lined)   
 
-    if not lines or not "JIB" in lined[0]:
+    # Markers sit at fixed lines; 39 header lines plus the PIE line at minimum
+    if lines < 40 or not lined[0].startswith("JIB"):
         print("Error: Not ProTrackII file")
-        sys.exit(1)
-    if not "PIE" in lined[lines-1]:  
+        return False
+    if not lined[lines-1].startswith("PIE"):  
         print("Error: Not ProTrackII profile does not exist PIE \"%s\"" % lined[lines-1])
-        sys.exit(1)  
-    if not "JIE" in lined[33]:  
+        return False  
+    if not lined[33].startswith("JIE"):  
         print("Error: Not ProTrackII profile does not exist JIE \"%s\"" % lined[33])
-        sys.exit(1)  
-    if not "PIB" in lined[34]:  
-        print("Error: Not ProTrackII profile does not exist JIE \"%s\"" % lined[34])
-        sys.exit(1)  
-        
-    # Lists
-    AltiMeterList   = []
-    SpeedList       = []
-    SasSpeedList    = []
-    AccelList       = []   
-    SasMeterList    = []
-    i = 0
-    DeploymentIndex = -1        
+        return False  
+    if not lined[34].startswith("PIB"):  
+        print("Error: Not ProTrackII profile does not exist PIB \"%s\"" % lined[34])
+        return False  
         
     # Extract information from protrackii txt file
     #  Data deliminted by line number.
@@ -178,7 +215,10 @@ def main():
     SerialNumber    = lined[4]          # ProTrack2 Serial Number: YYMMDDHHMMSS
     JumpNumber      = int(lined[5])     # JumpNumber: Range 0-99999 
     datestr         = str("%s%s" % (lined[6],lined[7]))
-    datetime_object = datetime.strptime(datestr, '%Y%m%d%H%M%S')
+    if len(datestr) != 14 or not datestr.isdigit():
+        raise ValueError("jump date/time \"%s\" is not YYYYMMDDHHMMSS" % datestr)
+    datetime_object = datetime(int(datestr[0:4]), int(datestr[4:6]), int(datestr[6:8]),    # YYYYMMDD
+                               int(datestr[8:10]), int(datestr[10:12]), int(datestr[12:14])) # HHMMSS
     ExitAltitude    = int(lined[8])     # Exit Altitude: Range 0-99999 in metre
     DeploymentAltitude = int(lined[9])  # Deployment Altitude: Range 0-99999 in metre
     FreefallTime       = int(lined[10]) # Range 0-999 in seconds
@@ -218,20 +258,22 @@ def main():
     profileExists   = int(lined[36])     
     canopyDataInProfile = int(lined[37])  
     profilePoints   = int(lined[38]) 
-    JumpData        = ''.join(lined[39:lines-1]).split(",")
-    JumpData.pop()  # remove last element
-    JumpDataInt     = list(map(int, JumpData)) # convert strings to meters
+    JumpDataInt     = []  # pressure readings in dPa
+    for line in lined[39:lines-1]:  # each data line ends with a trailing comma
+        line = line.strip().rstrip(",")
+        if line:
+            JumpDataInt.extend(map(int, line.split(",")))
     
     GroundLevelmbar = DecaPaToMiliBar(GroundLeveldPa) # Pressure at ground level. 
-    GroundLevelMeter = (int)(STANDARD_TEMP_k * (1.0 - pow(GroundLeveldPa / SL_PRESSURE_DPA, BARO_POWER)))    
+    hs = PressureToSeaLevelMeter(GroundLeveldPa)  # ground level above sea level (m)
+    GroundLevelMeter = (int)(hs)    
     exit_dbar = JumpDataInt[IndexExit]
     
     #IcaoTempC = TempC-(6.5*ExitAltitude/1000)   # Convert temperature at DZ to Temp at SeaLevel 6.5C per 1000 meter 
-    IcaoTempC = round(15-(STANDARD_TEMP_k*(1- pow((exit_dbar/SL_PRESSURE_DPA),BARO_POWER))*0.0065))
+    IcaoTempC = round(15-(PressureToSeaLevelMeter(exit_dbar)*0.0065))
     
     icao_div = IcaoTempC # incase Fahrenheit
-    hs = (STANDARD_TEMP_k*(1-pow((GroundLeveldPa/SL_PRESSURE_DPA),BARO_POWER)))
-    ht = (STANDARD_TEMP_k*(1-pow((GroundLeveldPa/SL_PRESSURE_DPA),BARO_POWER)))*(1+((icao_div)*0.004))
+    ht = hs*(1+(icao_div*0.004))
     
     """
     print("exit_dbar: %0.1f dpa" % exit_dbar)
@@ -241,43 +283,7 @@ def main():
     print("TempC: %0.1fC" % TempC)
     """
         
-    for readingDBar in JumpDataInt:
-        alti = PressureToMeter(readingDBar, GroundLevelMeter)
-        AltiMeterList.append(alti)
-                
-        # SAS meter table
-        sasmeter = (STANDARD_TEMP_k*(1 - pow((readingDBar/SL_PRESSURE_DPA),BARO_POWER)))*(1+(icao_div*0.004))+(hs-ht)+GroundLevelMeter
-        SasMeterList.append(sasmeter)
-        
-        #set deployment index
-        if alti <= DeploymentAltitude and DeploymentIndex == -1:
-            DeploymentIndex = i
-        
-        i+=1
-    
-    #speed calculations
-    i = 0
-    for i in range(IndexExit+IndexIncForSpeedInFF, len(AltiMeterList)): 
-        if AltiMeterList[i] > DeploymentAltitude:
-            timeinterval = TimeIncForSpeedInFF
-            idxinc       = IndexIncForSpeedInFF
-        else:
-            timeinterval = TimeIncForSpeedCanopy
-            idxinc       = IndexIncForSpeedCanopy
-
-        # setup the contants for SAS as per LB's code                
-        speed = (AltiMeterList[i -idxinc] - AltiMeterList[i]) / timeinterval
-        SpeedList.append(speed)
-        
-        # Now calculate SAS
-        SasSpeed = (SasMeterList[i -idxinc] - SasMeterList[i]) / timeinterval
-        SasSpeedList.append(SasSpeed)    
-        
-    # Calculate acceleration             
-    i = 0        
-    for i in range(1,len(SpeedList)):
-        AccelList.append( (MsecToMsec(SpeedList[i]) - MsecToMsec(SpeedList[i-1])) / TimeStep / A_GRAVITY )
-        i+=1
+    profile = ComputeProfile(JumpDataInt, GroundLevelMeter, icao_div, hs, ht, DeploymentAltitude)
 
     # print the data we don't care about
     print("Timestamp: %s" % str(datetime_object))
@@ -298,41 +304,94 @@ def main():
         outf = str("%s.csv" % JumpNumber)
     with open(outf, 'w') as csvfile:     
         csvfile.write(str("Time(s),Altitude(ft),TAS(mph),SAS LB(mph),Comments\n") )
-        for i in range(0,len(AltiMeterList)):               
+        for i in range(0,len(profile.AltiMeterList)):               
             t       = IndexToTime(i)
-            if t<0 or t > IndexToTime(DeploymentIndex):
+            if t<0 or t > IndexToTime(profile.DeploymentIndex):
                 continue
-            alti    = AltiMeterList[i]
-            tas     = SpeedList[i]
-            sas     = SasSpeedList[i]
-            accel   = AccelList[i]
-            sasmeter = SasMeterList[i]
+            alti    = profile.AltiMeterList[i]
+            tas     = profile.SpeedList[i]
+            sas     = profile.SasSpeedList[i]
+            accel   = profile.AccelList[i]
+            sasmeter = profile.SasMeterList[i]
                         
-            if(i == DeploymentIndex):
+            if(i == profile.DeploymentIndex):
                 comment = "Deployment"
             elif( i == IndexExit ):
                 comment = "Exit"
-            elif(t == TimeSpeedStarts):
+            elif(i == IndexSpeedStart):
                 comment = "Speed Accurate"
             else:
                 comment = ""
             csvfile.write(str("%f,%d,%0.0f,%0.0f,%s\n" % (t, MToft(alti), MsecTomph(tas), MsecTomph(sas), comment))) 
     """
     if not outf:
-        outf = str("%s.csv" % JumpNumber)
+        outf = os.path.join(outdir, "%s.csv" % JumpNumber)
+    if written is not None:
+        outkey = os.path.normcase(os.path.abspath(outf))
+        if outkey in written:
+            print("Error: \"%s\" already written by another file in this run, jump %d skipped" % (outf, JumpNumber))
+            return False
+        written.add(outkey)
+    # Speed lists start IndexIncForSpeedInFF samples after exit
+    SpeedStartIndex = TimeToIndex(0) + IndexIncForSpeedInFF
+    FreefallAlti = profile.AltiMeterList[SpeedStartIndex:]
+    FreefallEnd = next((i for i, alti in enumerate(FreefallAlti) if alti <= DeploymentAltitude), len(FreefallAlti))
+
+    # Altitude (ft) and SAS (mph) for each freefall row
+    AltiFt = [round(alti * M_TO_FT) for alti in FreefallAlti[:FreefallEnd]]
+    SasMph = [round(sas * MSEC_TO_MPH) for sas in profile.SasSpeedList[:FreefallEnd]]
+    rows = ["Altitude(ft),SAS(mph)\n"]
+    rows.extend("%d,%0.0f\n" % row for row in zip(AltiFt, SasMph))
+
     with open(outf, 'w') as csvfile:     
-        csvfile.write(str("Altitude(ft),SAS(mph)\n") )
-        for i in range(0,len(SasSpeedList)):               
-            exitidx = TimeToIndex(0)
-            
-            alti    = AltiMeterList[i+exitidx+IndexIncForSpeedInFF]
-            if(alti <= DeploymentAltitude):
-                break
-            
-            tas     = SpeedList[i]
-            sas     = SasSpeedList[i]
-                        
-            csvfile.write(str("%d,%0.0f\n" % (MToft(alti), MsecTomph(sas)))) 
+        csvfile.write("".join(rows))
+
+    return True
+
+#
+# Main
+#     
+def main():
+    if len(sys.argv) < 2:
+        print("Missing arguments: %s <input.txt|input dir> <output>" % sys.argv[0])
+        sys.exit()
+        
+    inf= sys.argv[1]   
+    if len(sys.argv) < 3: 
+        outf = None
+    else:
+        outf = sys.argv[2]
+    
+    # Batch mode: extract every .txt in a directory in one run, output is a directory
+    if(os.path.isdir(inf)):
+        outdir = outf or ""
+        if outdir and os.path.exists(outdir) and not os.path.isdir(outdir):
+            print("Output \"%s\" exists and is not a directory" % outdir)
+            sys.exit(1)
+        if outdir and not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        ok = True
+        written = set()
+        for name in sorted(os.listdir(inf)):
+            path = os.path.join(inf, name)
+            if name.lower().endswith(".txt") and os.path.isfile(path):
+                print("== %s" % name)
+                try:
+                    ok = ExtractFile(path, None, outdir, written) and ok
+                except (ValueError, IndexError) as e:
+                    print("Error: Malformed ProTrackII file \"%s\": %s" % (name, e))
+                    ok = False
+                except OSError as e:
+                    print("Error: Cannot extract \"%s\": %s" % (name, e))
+                    ok = False
+        sys.exit(0 if ok else 1)
+
+    if(not os.path.isfile(inf)):
+        print("Input file \"%s\" does not exist" % inf)
+        sys.exit(1)
+    
+    if not ExtractFile(inf, outf):
+        sys.exit(1)
             
 if __name__ == "__main__":
     main()
\ No newline at end of file